@@ -1,5 +1,6 @@
 # distutils: language = c++
 import pymzml
+import numpy as np
 from libcpp.map cimport map
 from libcpp.vector cimport vector
 from cython.operator cimport dereference, postincrement, postdecrement
@@ -167,6 +168,6 @@ def get_ROIs(str path, float delta_mz=0.005, int required_points=15, int dropped
         roi.scan_end = roi.scan_end + dropped_points
 
         python_rois.append(ROI([roi.scan_begin, roi.scan_end], [roi.rt_begin, roi.rt_end],
-                               roi.i, roi.mz, roi.mz_mean))
+                               np.ascontiguousarray(roi.i, dtype=np.float32), roi.mz, roi.mz_mean))
         postincrement(roi_it)
     return python_rois
@@ -284,7 +284,7 @@ class EvaluationMainWindow(QtWidgets.QDialog):
                 features = self.runner(roi, 'predicted/' + file)
                 # append gt (ground truth) features
                 for border in dict_roi['borders']:
-                    gt = np.zeros(len(roi.i), dtype=np.bool)
+                    gt = np.zeros(len(roi.i), dtype=np.bool_)
                     gt[border[0]:border[1]+1] = 1
                     scan_frequency = (roi.scan[1] - roi.scan[0]) / (roi.rt[1] - roi.rt[0])
                     rtmin = roi.rt[0] + border[0] / scan_frequency
@@ -293,18 +293,18 @@ class EvaluationMainWindow(QtWidgets.QDialog):
                     for feature in features:
                         if len(feature) == 1 and feature.samples[0][:2] == 'pr':
                             predicted_border = feature.borders[0]
-                            pred = np.zeros(len(roi.i), dtype=np.bool)
+                            pred = np.zeros(len(roi.i), dtype=np.bool_)
                             pred[predicted_border[0]:predicted_border[1]+1] = 1
                             # calculate iou
                             intersection = (pred & gt).sum()  # will be zero if Truth=0 or Prediction=0
                             union = (pred | gt).sum()
                             if intersection / union > 0.5:
                                 match = True
-                                feature.append('gt/' + file, roi, border, 0, np.sum(roi.i[border[0]:border[1]]),
+                                feature.append('gt/' + file, roi, border, 0, roi.integrate(border[0], border[1]),
                                                roi.mzmean, rtmin, rtmax)
                                 break
                     if not match:
-                        features.append(Feature(['gt/' + file], [roi], [border], [0], [np.sum(roi.i[border[0]:border[1]])],
+                        features.append(Feature(['gt/' + file], [roi], [border], [0], [roi.integrate(border[0], border[1])],
                                                 roi.mzmean, rtmin, rtmax, 0, 0))
 
                 # append tp, tn, fp, fn
@@ -377,7 +377,7 @@ class EvaluationStatisticsWindow(QtWidgets.QDialog):
         self.plot_confusion_matrix(len(tp_features), len(tn_features), len(fp_features), len(fn_features))
 
     def plot_confusion_matrix(self, tp, tn, fp, fn):
-        confusion_matrix = np.zeros((2, 2), np.int)
+        confusion_matrix = np.zeros((2, 2), np.int64)
         confusion_matrix[0, 0] = tp
         confusion_matrix[0, 1] = fp
         confusion_matrix[1, 0] = fn
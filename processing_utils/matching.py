@@ -173,6 +173,16 @@ class groupedROI:
             self.samples.pop(idx)
             self.grouping.pop(idx)
 
+    def group2idx(self):
+        """
+        Mapping from similarity groups to ROIs
+        :return: a dict, where key is a group number and value is an array of ROI indexes (in ascending order)
+        """
+        grouping = np.array(self.grouping)
+        order = np.argsort(grouping, kind='stable')
+        labels, begins, counts = np.unique(grouping[order], return_index=True, return_counts=True)
+        return {label: order[begin:begin + count] for label, begin, count in zip(labels, begins, counts)}
+
     def plot(self, based_on_grouping=False):
         """
         Visualize a groupedROI object
@@ -1,22 +1,29 @@
 import os
 import torch
 import numpy as np
-from collections import defaultdict
-from scipy.interpolate import interp1d
-from processing_utils.matching import intersected, conv2correlation
+import torch.nn.functional as F
+from pathlib import Path
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from scipy.fft import rfft, irfft, next_fast_len
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.patches import Patch
 from itertools import permutations
+try:
+    from numba import njit
+except ImportError:  # numba is optional, the code runs as the plain python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
 
 
-def find_mzML(path, array=None):
-    if array is None:
-        array = []
-    for obj in os.listdir(path):
-        obj_path = os.path.join(path, obj)
-        if os.path.isdir(obj_path):  # object is a directory
-            find_mzML(obj_path, array)
-        elif obj_path[-4:] == 'mzML':  # object is mzML file
-            array.append(obj_path)
-    return array
+def find_mzML(path):
+    """
+    :param path: path to directory
+    :return: a list of paths to *.mzML files in the directory and all its subdirectories
+    """
+    return [str(file) for file in Path(path).rglob('*.mzML') if file.is_file()]
 
 
 def preprocess(signal, device, interpolate=False, length=None):
@@ -26,11 +33,90 @@ def preprocess(signal, device, interpolate=False, length=None):
     :param points: number of point needed for CNN
     :return: preprocessed intensities which can be used in CNN
     """
+    signal = torch.as_tensor(signal, dtype=torch.float32, device=device).view(1, 1, -1)
     if interpolate:
-        interpolate = interp1d(np.arange(len(signal)), signal, kind='linear')
-        signal = interpolate(np.arange(length) / (length - 1) * (len(signal) - 1))
-    signal = torch.tensor(signal / np.max(signal), dtype=torch.float32, device=device)
-    return signal.view(1, 1, -1)
+        signal = F.interpolate(signal, size=length, mode='linear', align_corners=True)
+    return signal / signal.amax(dim=-1, keepdim=True)
+
+
+def preprocess_batch(signals, device, length=256):
+    """
+    :param signals: a list of intensities in rois
+    :param device: cpu or gpu
+    :param length: number of point needed for CNN
+    :return: preprocessed intensities stacked into (n_signals x 1 x length) tensor
+    """
+    lengths = np.array([len(signal) for signal in signals])
+    batch = np.zeros((len(signals), np.max(lengths)), dtype=np.float32)  # signals padded with zeros
+    for k, signal in enumerate(signals):
+        batch[k, :lengths[k]] = signal
+    batch = torch.from_numpy(batch)
+    lengths = torch.from_numpy(lengths)
+    if torch.device(device).type == 'cuda':
+        batch = batch.pin_memory()  # allows asynchronous host to device copy
+    batch = batch.to(device, non_blocking=True)
+    lengths = lengths.to(device, non_blocking=True).view(-1, 1)
+
+    # linear interpolation of every signal within its own length (as align_corners=True)
+    scale = (lengths - 1).float() / (length - 1)
+    position = scale * torch.arange(length, dtype=torch.float32, device=batch.device)
+    left = position.long().minimum(lengths - 1)
+    right = (left + 1).minimum(lengths - 1)
+    weight = position - left.float()
+    left, right = batch.gather(1, left), batch.gather(1, right)
+    batch = left + weight * (right - left)
+    batch = batch / batch.amax(dim=-1, keepdim=True)
+    return batch.view(len(signals), 1, length)
+
+
+# threads preprocessing batches on CPU: shared by all calls, few of them, since
+# torch operations inside preprocess_batch already use the intra-op thread pool
+_preprocessing_executor = ThreadPoolExecutor(max_workers=2)
+
+
+def preprocessed_batches(signals, device, length=256, batch_size=64, prefetched=2):
+    """
+    Split signals into batches and preprocess them. On GPU the next batch is transferred
+    and preprocessed in a separate CUDA stream while the current one is processed by CNN,
+    on CPU the following batches are preprocessed in background threads
+    :param signals: a list of intensities in rois
+    :param device: cpu or gpu
+    :param length: number of point needed for CNN
+    :param batch_size: number of signals in one batch
+    :param prefetched: maximum number of batches preprocessed in advance on CPU
+    :return: generator of (batch_size x 1 x length) tensors
+    """
+    device = torch.device(device)
+    if device.type != 'cuda':
+        # numpy and torch release GIL, so batches are packed and interpolated in parallel with CNN
+        pending = deque()
+        for k in range(0, len(signals), batch_size):
+            pending.append(_preprocessing_executor.submit(preprocess_batch, signals[k:k + batch_size],
+                                                          device, length))
+            if len(pending) > prefetched:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+        return
+
+    preprocess_stream = torch.cuda.Stream(device)
+
+    def prefetch(k):
+        with torch.cuda.stream(preprocess_stream):
+            batch = preprocess_batch(signals[k:k + batch_size], device, length)
+        ready = torch.cuda.Event()
+        ready.record(preprocess_stream)
+        return batch, ready
+
+    following = prefetch(0) if signals else None
+    for k in range(0, len(signals), batch_size):
+        batch, ready = following
+        if k + batch_size < len(signals):
+            following = prefetch(k + batch_size)  # overlaps with processing of the current batch
+        inference_stream = torch.cuda.current_stream(device)
+        inference_stream.wait_event(ready)
+        batch.record_stream(inference_stream)  # batch memory is used outside of preprocess_stream
+        yield batch
 
 
 def classifier_prediction(roi, classifier, device, points=256):
@@ -41,9 +127,26 @@ def classifier_prediction(roi, classifier, device, points=256):
     :param points: number of point needed for CNN
     :return: class/label
     """
-    signal = preprocess(roi.i, device, points)
-    proba = classifier(signal)[0].softmax(0)
-    return np.argmax(proba.cpu().detach().numpy())
+    return int(classifier_prediction_batch([roi], classifier, device, points)[0])
+
+
+def classifier_prediction_batch(rois, classifier, device, points=256, batch_size=64):
+    """
+    :param rois: a list of ROI objects
+    :param classifier: CNN for classification
+    :param device: cpu or gpu
+    :param points: number of point needed for CNN
+    :param batch_size: number of rois processed by CNN at once
+    :return: np.array of classes/labels
+    """
+    labels = []
+    with torch.inference_mode():
+        for signal in preprocessed_batches([roi.i for roi in rois], device, points, batch_size):
+            classifier_output, _ = classifier(signal)
+            labels.append(classifier_output.argmax(1))  # stays on device, no synchronization
+    if not labels:
+        return np.zeros(0, dtype=np.int64)
+    return torch.cat(labels).cpu().numpy()  # the only device to host transfer
 
 
 def correct_classification(labels):
@@ -70,55 +173,86 @@ def border_prediction(roi, integrator, device, peak_minimum_points, points=256,
     :param split_threshold: threshold for probability of splitter
     :return: borders as an list of size n_peaks x 2
     """
-    signal = preprocess(roi.i, device, points)
-    logits = integrator(signal).sigmoid()
-    splitter = logits[0, 0, :].cpu().detach().numpy()
-    domain = (1 - splitter) * logits[0, 1, :].cpu().detach().numpy() > threshold
+    return border_prediction_batch([roi], integrator, device, peak_minimum_points,
+                                   points, split_threshold, threshold)[0]
+
+
+def border_prediction_batch(rois, integrator, device, peak_minimum_points, points=256,
+                            split_threshold=0.95, threshold=0.5, batch_size=64):
+    """
+    :param rois: a list of ROI objects
+    :param integrator: CNN for border prediction
+    :param device: cpu or gpu
+    :param peak_minimum_points: minimum points in peak
+    :param points: number of point needed for CNN
+    :param split_threshold: threshold for probability of splitter
+    :param batch_size: number of rois processed by CNN at once
+    :return: a list of borders (n_peaks x 2) for every roi
+    """
+    borders = []
+    with torch.inference_mode():
+        batches = preprocessed_batches([roi.i for roi in rois], device, points, batch_size)
+        for k, signal in zip(range(0, len(rois), batch_size), batches):
+            batch = rois[k:k + batch_size]
+            _, integrator_output = integrator(signal)
+            logits = integrator_output.sigmoid()
+            splitter = logits[:, 0, :]
+            # thresholding on device, only bool masks are transferred to host
+            split = (splitter > split_threshold).cpu().numpy()
+            domain = ((1 - splitter) * logits[:, 1, :] > threshold).cpu().numpy()
+            for n, roi in enumerate(batch):
+                borders.append(domain2borders(roi, split[n], domain[n], peak_minimum_points, points))
+    return borders
+
+
+def domain2borders(roi, split, domain, peak_minimum_points, points=256):
+    """
+    :param roi: an ROI object
+    :param split: predicted splitter points (bool mask)
+    :param domain: predicted integration domain (bool mask)
+    :param peak_minimum_points: minimum points in peak
+    :param points: number of point needed for CNN
+    :return: borders as an list of size n_peaks x 2
+    """
+    regions, _ = _scan_domain(np.asarray(domain, dtype=np.bool_))  # to do: if the peak doesn't end?
+    peak_wide = regions[:, 1] - regions[:, 0] - 1
+    borders_signal = regions[peak_wide / points * len(roi.i) > peak_minimum_points]
+    borders_roi = np.column_stack((np.maximum((borders_signal[:, 0] + 1) * len(roi.i) // points - 1, 0),
+                                   borders_signal[:, 1] * len(roi.i) // points))
 
-    borders_signal = []
-    borders_roi = []
-    begin = 0 if domain[0] else -1
-    peak_wide = 1 if domain[0] else 0
-    number_of_peaks = 0
-    for n in range(len(domain) - 1):
-        if domain[n + 1] and not domain[n]:  # peak begins
-            begin = n + 1
-            peak_wide = 1
-        elif domain[n + 1] and begin != -1:  # peak continues
-            peak_wide += 1
-        elif not domain[n + 1] and begin != -1:  # peak ends
-            if peak_wide / points * len(roi.i) > peak_minimum_points:
-                number_of_peaks += 1
-                borders_signal.append([begin, n + 2])  # to do: why n+2?
-                borders_roi.append([np.max((int((begin + 1) * len(roi.i) // points - 1), 0)),
-                                    int((n + 2) * len(roi.i) // points - 1) + 1])
-            begin = -1
-            peak_wide = 0
-    # to do: if the peak doesn't end?
     # delete the smallest peak if there is no splitter between them
-    n = 0
-    while n < number_of_peaks - 1:
-        if not np.any(splitter[borders_signal[n][1]:borders_signal[n + 1][0]] > split_threshold):
-            intensity1 = np.sum(roi.i[borders_roi[n][0]:borders_signal[n][1]])
-            intensity2 = np.sum(roi.i[borders_roi[n + 1][0]:borders_signal[n + 1][1]])
-            smallest = n if intensity1 < intensity2 else n + 1
-            borders_signal.pop(smallest)
-            borders_roi.pop(smallest)
-            number_of_peaks -= 1
-        else:
-            n += 1
-    return borders_roi
+    # (prefix sums give the number of splitters and intensity between any points in O(1))
+    split_cum = np.concatenate(([0], np.cumsum(split)))
+    i_cum = roi.cumsum
+    begin = np.minimum(borders_roi[:, 0], len(roi.i))
+    end = np.minimum(borders_signal[:, 1], len(roi.i))
+    intensity = np.where(begin < end, i_cum[end] - i_cum[begin], 0)
+    survived = np.ones(len(borders_roi), dtype=np.bool_)
+    n = 0  # the last survived peak
+    for m in range(1, len(borders_roi)):
+        if split_cum[borders_signal[m, 0]] - split_cum[borders_signal[n, 1]] <= 0:
+            smallest = n if intensity[n] < intensity[m] else m
+            survived[smallest] = False
+            if smallest == m:
+                continue
+        n = m
+    return borders_roi[survived].tolist()
 
 
 def border_intersection(border, avg_border):
     """
-    Check if borders intersect
+    Check if borders intersect (the same criterion as intersected with percentage, but without
+    branches, so arrays of borders of shape (..., 2) are broadcasted against each other)
     :param border: the real border in number of scans
     :param avg_border: averaged within similarity group border in number of scans
-    :return: True/False
+    :return: True/False (bool array for arrays of borders)
     """
-    # to do: adjustable parameter?
-    return intersected(border[0], border[1], avg_border[0], avg_border[1], 0.6)
+    border, avg_border = np.asarray(border), np.asarray(avg_border)
+    intersection = np.minimum(border[..., 1], avg_border[..., 1]) - np.maximum(border[..., 0], avg_border[..., 0])
+    smallest = np.minimum(border[..., 1] - border[..., 0], avg_border[..., 1] - avg_border[..., 0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # to do: adjustable parameter?
+        return (intersection > 0) & (intersection / smallest > 0.6)
 
 
 def get_borders(integration_mask, intersection_mask, peak_minimum_points=5,
@@ -138,32 +272,50 @@ def get_borders(integration_mask, intersection_mask, peak_minimum_points=5,
 
     """
     domain = integration_mask * (1 - intersection_mask) > threshold
-    borders_roi = []
-    begin = 0 if domain[0] else -1
-    peak_wide = 1 if domain[0] else 0
-    number_of_peaks = 0
-    for n in range(len(domain) - 1):
-        if domain[n + 1] and not domain[n]:  # peak begins
-            begin = n + 1
-            peak_wide = 1
-        elif domain[n + 1] and begin != -1:  # peak continues
-            peak_wide += 1
-        elif not domain[n + 1] and begin != -1:  # peak ends
-            if peak_wide / interpolation_factor > peak_minimum_points:
-                number_of_peaks += 1
-                b = int(begin // interpolation_factor)
-                e = int((n + 2) // interpolation_factor)  # to do: why n+2?
-                borders_roi.append([b, e])
-            begin = -1
-            peak_wide = 0
-    if begin != -1 and peak_wide * interpolation_factor > peak_minimum_points:
-        number_of_peaks += 1
+    return get_domain_borders(domain, peak_minimum_points, interpolation_factor)
+
+
+def get_domain_borders(domain, peak_minimum_points=5, interpolation_factor=1):
+    """
+    Borders of peaks in already thresholded integration domain
+    :param domain: integration domain (bool mask)
+    :param peak_minimum_points: minimum points in peak
+    :param interpolation_factor: ratio of domain length to the length of roi
+    :return: borders as an list of size n_peaks x 2
+    """
+    regions, begin = _scan_domain(np.asarray(domain, dtype=np.bool_))
+    peak_wide = regions[:, 1] - regions[:, 0] - 1
+    regions = regions[peak_wide / interpolation_factor > peak_minimum_points]
+    borders_roi = (regions // interpolation_factor).astype(np.int64).tolist()
+    if begin != -1 and (len(domain) - begin) * interpolation_factor > peak_minimum_points:
         b = int(begin // interpolation_factor)
         e = int(len(domain) // interpolation_factor)
         borders_roi.append([b, e])
     return borders_roi
 
 
+@njit(cache=True)
+def _scan_domain(domain):
+    """
+    Find continuous regions of True values in the mask
+    :param domain: bool mask
+    :return: (n_regions x 2) array with [begin, end] of regions that ended and
+        the begin of region that reaches the end of mask (-1 if there is no such region)
+    """
+    regions = np.empty(((len(domain) + 1) // 2, 2), dtype=np.int64)
+    number_of_regions = 0
+    begin = 0 if domain[0] else -1
+    for n in range(len(domain) - 1):
+        if domain[n + 1] and not domain[n]:  # region begins
+            begin = n + 1
+        elif not domain[n + 1] and begin != -1:  # region ends
+            regions[number_of_regions, 0] = begin
+            regions[number_of_regions, 1] = n + 2  # to do: why n+2?
+            number_of_regions += 1
+            begin = -1
+    return regions[:number_of_regions], begin
+
+
 def border2average_correction(borders, averaged_borders):
     """
     Correct borders based on averaged borders
@@ -173,30 +325,36 @@ def border2average_correction(borders, averaged_borders):
     """
     # to do: use that borders are sorted in fact
     if len(borders) != 1 and len(borders) == len(averaged_borders):  # to do: not the best solution
-        mapping_matrix = np.eye(len(borders), dtype=np.int)
+        mapping_matrix = np.eye(len(borders), dtype=np.bool_)
     else:
-        mapping_matrix = np.zeros((len(borders), len(averaged_borders)), dtype=np.int)
-        for i, border in enumerate(borders):
-            for j, avg_border in enumerate(averaged_borders):
-                mapping_matrix[i, j] += border_intersection(border, avg_border)
+        # all pairwise intersections at once
+        mapping_matrix = border_intersection(np.reshape(borders, (-1, 1, 2)),
+                                             np.reshape(averaged_borders, (1, -1, 2)))
+
+    # matrices are tiny, so row/column sums are computed once (and kept up to date)
+    # instead of calling numpy for every line
+    row_sums = mapping_matrix.sum(axis=1).tolist()
 
     # 'many-to-many' case resolution
     # to do: 'many-to-many' should be impossible ?
     for i, line in enumerate(mapping_matrix):
-        if np.sum(line) > 1:
-            for j in np.where(line == 1)[0][:-1]:
+        if row_sums[i] > 1:
+            for j in np.flatnonzero(line).tolist()[:-1]:
                 if j + 1 < len(mapping_matrix) and mapping_matrix[j + 1, j] == 1:
                     mapping_matrix[j + 1, j] = 0
-                if j + 1 < len(mapping_matrix) and mapping_matrix[j + 1, j + 1] == 1:
+                    row_sums[j + 1] -= 1
+                if j + 1 < len(mapping_matrix) and mapping_matrix[j + 1, j + 1] == 1 and mapping_matrix[j, j + 1] == 1:
                     mapping_matrix[j, j + 1] = 0
+                    row_sums[j] -= 1
+    column_sums = mapping_matrix.sum(axis=0).tolist()
 
     corrected_borders = []
     added = np.zeros(len(borders), dtype=np.uint8)
     for i, line in enumerate(mapping_matrix):
-        if np.sum(line) > 1:  # misssing separation (even multiple almost impossible case)
+        if row_sums[i] > 1:  # misssing separation (even multiple almost impossible case)
             current = 1
-            total = np.sum(line)
-            for j in np.where(line == 1)[0]:
+            total = row_sums[i]
+            for j in np.flatnonzero(line).tolist():
                 if current == 1:
                     begin = min((borders[i][0], averaged_borders[j][0]))
                     corrected_borders.append([begin, averaged_borders[j][1]])
@@ -207,28 +365,28 @@ def border2average_correction(borders, averaged_borders):
                     corrected_borders.append([end, borders[i][1]])
                 current += 1
             added[i] = 1  # added border from original borders
-        elif np.sum(line) == 0:  # extra peak
+        elif row_sums[i] == 0:  # extra peak
             # label that added to exclude
             added[i] = 1
 
     for j, column in enumerate(mapping_matrix.T):
-        if np.sum(column) > 1:  # redundant separation
+        if column_sums[j] > 1:  # redundant separation
             begin, end = None, None
-            for i in np.where(column == 1)[0]:
+            for i in np.flatnonzero(column).tolist():
                 if begin is None and end is None:
                     begin, end = borders[i]
                 else:
-                    begin = np.min((begin, borders[i][0]))
-                    end = np.max((end, borders[i][1]))
+                    begin = min(begin, borders[i][0])
+                    end = max(end, borders[i][1])
                 assert added[i] != 1, '"many-to-many" case here must be impossible!'
                 added[i] = 1
             corrected_borders.append([begin, end])
-        elif np.sum(column) == 0:  # missed peak
+        elif column_sums[j] == 0:  # missed peak
             # added averaged borders
             corrected_borders.append(averaged_borders[j])
 
     # add the ramaining ("one-to-one") cases
-    for i in np.where(added == 0)[0]:
+    for i in np.flatnonzero(added == 0).tolist():
         corrected_borders.append(borders[i])
 
     # sort corrected borders
@@ -256,72 +414,45 @@ def border_correction(component, borders):
         scan_borders[sample] = shifted_borders
 
     # border correction within the similarity group
-    labels = np.unique(component.grouping)
-    for label in labels:
+    scans = np.array([roi.scan for roi in component.rois]) + np.array(component.shifts).reshape(-1, 1)
+    for label, group in component.group2idx().items():
         # find total begin and end in one similarity group
-        total_begin, total_end = None, None
+        total_begin = int(np.min(scans[group, 0]))
+        total_end = int(np.max(scans[group, 1]))
         # and maximum number of peaks
-        max_number_of_peaks = 0
-        for i, sample in enumerate(component.samples):
-            # to do: it would be better to have mapping from group to samples and numbers
-            if component.grouping[i] == label:
-                shift = component.shifts[i]
-                if total_begin is None and total_end is None:
-                    total_begin, total_end = component.rois[i].scan
-                    total_begin += shift
-                    total_end += shift
-                else:
-                    begin, end = component.rois[i].scan
-                    total_begin = min((total_begin, begin + shift))
-                    total_end = max((total_end, end + shift))
-                max_number_of_peaks = max((max_number_of_peaks, len(borders[sample])))
+        max_number_of_peaks = max(len(borders[component.samples[i]]) for i in group)
 
         # find averaged integration domains
-        averaged_domain = np.zeros(total_end - total_begin)
-        samples_in_group = 0
-        for i, sample in enumerate(component.samples):
-            # to do: it would be better to have mapping from group to samples and numbers
-            if component.grouping[i] == label:
-                samples_in_group += 1
-                for border in scan_borders[sample]:
-                    averaged_domain[border[0] - total_begin:border[1] - total_begin] += 1
-        averaged_domain = averaged_domain / samples_in_group
+        length = total_end - total_begin
+        group_borders = [border for i in group for border in scan_borders[component.samples[i]]]
+        samples_in_group = len(group)
+        # each border adds +1 at its begin and -1 at its end, cumulative sum gives the coverage
+        begins, ends = np.clip(np.asarray(group_borders, dtype=np.int64).reshape(-1, 2) - total_begin, 0, length).T
+        valid = begins < ends
+        delta = np.bincount(begins[valid], minlength=length + 1) - np.bincount(ends[valid], minlength=length + 1)
+        averaged_domain = np.cumsum(delta[:-1]) / samples_in_group
 
         # calculate number of peaks within similarity group
         averaged_domain = averaged_domain > 0.5  # to do: adjustable parameter?
-        number_of_peaks = 0
-        averaged_borders = []
-        begin = 0 if averaged_domain[0] else - 1
         # to do: think about peak wide and peak minimum points
-        # to do: the following code is almost the exact copy
-        # of the part of border_prediction function. Separate function?
-        for n in range(len(averaged_domain) - 1):
-            if averaged_domain[n + 1] and not averaged_domain[n]:  # peak begins
-                begin = n + 1
-            elif not averaged_domain[n + 1] and begin != -1:  # peak ends
-                number_of_peaks += 1
-                averaged_borders.append([begin + total_begin, n + 2 + total_begin])  # to do: why n+2?
-                begin = -1
+        regions, begin = _scan_domain(averaged_domain)
+        averaged_borders = (regions + total_begin).tolist()
         if begin != -1:
-            number_of_peaks += 1
             averaged_borders.append([begin + total_begin, len(averaged_domain) + 1 + total_begin])  # to do: why n+2?
-            begin = -1
+        number_of_peaks = len(averaged_borders)
 
         while number_of_peaks > max_number_of_peaks:  # need to merge some borders
             # to do: rethink this idea
             # compute 'many-to-one' cases
             counter = np.zeros(number_of_peaks)
-            for i, sample in enumerate(component.samples):
-                # to do: it would be better to have mapping from group to samples and numbers
-                if component.grouping[i] == label:
-                    mapping_matrix = np.zeros((len(scan_borders[sample]), len(averaged_borders)), dtype=np.int)
-                    for k, border in enumerate(scan_borders[sample]):
-                        for j, avg_border in enumerate(averaged_borders):
-                            mapping_matrix[k, j] += border_intersection(border, avg_border)
-                    for line in mapping_matrix:
-                        if np.sum(line) > 1:
-                            for j in np.where(line == 1):
-                                counter[j] += 1
+            for i in group:
+                sample = component.samples[i]
+                mapping_matrix = border_intersection(np.reshape(scan_borders[sample], (-1, 1, 2)),
+                                                     np.reshape(averaged_borders, (1, -1, 2)))
+                for line in mapping_matrix:
+                    if np.sum(line) > 1:
+                        for j in np.where(line == 1):
+                            counter[j] += 1
             counter_order = np.argsort(counter)
             assert np.abs(counter_order[-1] - counter_order[-2]) == 1, "almost impossible case :)"
             mergeable = min((counter_order[-1], counter_order[-2]))
@@ -330,21 +461,20 @@ def border_correction(component, borders):
             number_of_peaks -= 1
 
         # finally border correctrion
-        for i, sample in enumerate(component.samples):
-            # to do: it would be better to have mapping from group to samples and numbers
-            if component.grouping[i] == label:
-                scan_borders[sample] = border2average_correction(scan_borders[sample], averaged_borders)
-                # to do: add border2borders_correction
-
-        # change initial borders (reverse shift of scan_borders)
-        for k, sample in enumerate(component.samples):
-            scan_begin, _ = component.rois[k].scan
-            shift = component.shifts[k]
-            shifted_borders = []
-            for border in scan_borders[sample]:
-                shifted_borders.append([max((border[0] - scan_begin - shift, 0)),
-                                        max((1, min((border[1] - scan_begin - shift, len(component.rois[k].i)))))])
-            borders[sample] = shifted_borders
+        for i in group:
+            sample = component.samples[i]
+            scan_borders[sample] = border2average_correction(scan_borders[sample], averaged_borders)
+            # to do: add border2borders_correction
+
+    # change initial borders (reverse shift of scan_borders)
+    for k, sample in enumerate(component.samples):
+        scan_begin, _ = component.rois[k].scan
+        shift = component.shifts[k]
+        shifted_borders = []
+        for border in scan_borders[sample]:
+            shifted_borders.append([max((border[0] - scan_begin - shift, 0)),
+                                    max((1, min((border[1] - scan_begin - shift, len(component.rois[k].i)))))])
+        borders[sample] = shifted_borders
 
 
 class Feature:
@@ -357,7 +487,8 @@ class Feature:
         self.borders = borders
         self.shifts = shifts
         # feature specific information
-        self.intensities = intensities
+        self._intensities = list(intensities)
+        self._intensities_array = None  # converted from the list lazily
         self.mz = mz
         self.rtmin = rtmin
         self.rtmax = rtmax
@@ -368,6 +499,12 @@ class Feature:
     def __len__(self):
         return len(self.samples)
 
+    @property
+    def intensities(self):
+        if self._intensities_array is None:
+            self._intensities_array = np.asarray(self._intensities)
+        return self._intensities_array
+
     def append(self, sample, roi, border, shift,
                intensity, mz, rtmin, rtmax):
         if self.samples:
@@ -383,7 +520,8 @@ class Feature:
         self.rois.append(roi)
         self.borders.append(border)
         self.shifts.append(shift)
-        self.intensities.append(intensity)
+        self._intensities.append(intensity)
+        self._intensities_array = None
 
     def extend(self, feature):
         if self.samples:
@@ -399,38 +537,42 @@ class Feature:
         self.rois.extend(feature.rois)
         self.borders.extend(feature.borders)
         self.shifts.extend(feature.shifts)
-        self.intensities.extend(feature.intensities)
+        self._intensities.extend(feature._intensities)
+        self._intensities_array = None
 
     def plot(self, ax, shifted=True, show_legend=True):
         """
         Visualize Feature object
         """
-        name2label = {}
-        label2class = {}
-        labels = set()
-        for sample in self.samples:
-            label = os.path.basename(os.path.dirname(sample))
-            labels.add(label)
-            name2label[sample] = label
-
-        for i, label in enumerate(labels):
-            label2class[label] = i
-
-        m = len(labels)
+        # samples are colored by their directories
+        name2label = {sample: os.path.basename(os.path.dirname(sample)) for sample in self.samples}
+        label2class = {label: i for i, label in enumerate(set(name2label.values()))}
+
+        m = len(label2class)
+        lines, line_colors, fills, fill_colors, handles = [], [], [], [], []
         for sample, roi, shift, border in sorted(zip(self.samples, self.rois, self.shifts, self.borders),
                                                  key=lambda zipped: zipped[0]):
-            y = roi.i
+            y = np.asarray(roi.i)
             if shifted:
                 x = np.linspace(roi.scan[0] + shift, roi.scan[1] + shift, len(y))
             else:
                 x = np.linspace(roi.scan[0], roi.scan[1], len(y))
             label = label2class[name2label[sample]]
             c = [label / m, 0.0, (m - label) / m]
-            ax.plot(x, y, color=c)
-            ax.fill_between(x[border[0]:border[1]], y[border[0]:border[1]], color=c,
-                            alpha=0.5, label=os.path.basename(sample))
+            lines.append(np.column_stack((x, y)))
+            line_colors.append(c)
+            x_fill, y_fill = x[border[0]:border[1]], y[border[0]:border[1]]
+            if len(x_fill):  # polygon between the curve and zero (as fill_between)
+                fills.append(np.column_stack((np.concatenate(([x_fill[0]], x_fill, [x_fill[-1]])),
+                                              np.concatenate(([0], y_fill, [0])))))
+                fill_colors.append(c)
+            handles.append(Patch(color=c, alpha=0.5, label=os.path.basename(sample)))
+        # one artist for all lines and one for all fills instead of two per sample
+        ax.add_collection(LineCollection(lines, colors=line_colors))
+        ax.add_collection(PolyCollection(fills, facecolors=fill_colors, edgecolors=fill_colors, alpha=0.5))
+        ax.autoscale_view()
         if show_legend:
-            ax.legend(loc='best')
+            ax.legend(handles=handles, loc='best')
 
 
 def build_features(component, borders, initial_group):
@@ -447,44 +589,33 @@ def build_features(component, borders, initial_group):
     frequency = scandiff / rtdiff
 
     features = []
-    labels = np.unique(component.grouping)
-    for label in labels:
+    for label, group in component.group2idx().items():
         # compute number of peaks
-        peak_number = None
-        for i, sample in enumerate(component.samples):
-            # to do: it would be better to have mapping from group to samples and numbers
-            if component.grouping[i] == label:
-                peak_number = len(borders[sample])
-
+        peak_number = len(borders[component.samples[group[-1]]])
+        if peak_number == 0:
+            continue
+
+        samples = [component.samples[i] for i in group]
+        rois = [component.rois[i] for i in group]
+        shifts = [component.shifts[i] for i in group]
+        assert all(len(borders[sample]) == peak_number for sample in samples)
+        begins, ends = np.array([borders[sample] for sample in samples], dtype=np.int64).transpose(2, 0, 1)
+
+        # integrate all peaks of a sample at once: every peak is a lookup in the prefix sum
+        # of roi (cum[end] - cum[begin]) instead of a reduction
+        intensities = np.zeros(begins.shape)
+        for k, roi in enumerate(rois):
+            starts = np.clip(begins[k], 0, len(roi.i))
+            stops = np.clip(ends[k], 0, len(roi.i))
+            intensities[k] = np.where(starts < stops, roi.cumsum[stops] - roi.cumsum[starts], 0.)  # empty segments
+
+        mz = float(np.mean([roi.mzmean for roi in rois]))
+        rt_begin = np.array([roi.rt[0] for roi in rois]).reshape(-1, 1)
+        rtmin = np.min(rt_begin + begins / frequency, axis=0)
+        rtmax = np.max(rt_begin + ends / frequency, axis=0)
         for p in range(peak_number):
-            # build feature
-            intensities = []
-            samples = []
-            rois = []
-            feature_borders = []
-            shifts = []
-            rtmin, rtmax, mz = None, None, None
-            for i, sample in enumerate(component.samples):
-                # to do: it would be better to have mapping from group to samples and numbers
-                if component.grouping[i] == label:
-                    assert len(borders[sample]) == peak_number
-                    begin, end = borders[sample][p]
-                    intensity = np.sum(component.rois[i].i[begin:end])
-                    intensities.append(intensity)
-                    samples.append(sample)
-                    rois.append(component.rois[i])
-                    feature_borders.append(borders[sample][p])
-                    shifts.append(component.shifts[i])
-                    if mz is None:
-                        mz = component.rois[i].mzmean
-                        rtmin = component.rois[i].rt[0] + begin / frequency
-                        rtmax = component.rois[i].rt[0] + end / frequency
-                    else:
-                        mz = (mz * i + component.rois[i].mzmean) / (i + 1)
-                        rtmin = min((rtmin, component.rois[i].rt[0] + begin / frequency))
-                        rtmax = max((rtmax, component.rois[i].rt[0] + end / frequency))
-            features.append(Feature(samples, rois, feature_borders, shifts,
-                                    intensities, mz, rtmin, rtmax,
+            features.append(Feature(list(samples), list(rois), [borders[sample][p] for sample in samples],
+                                    list(shifts), intensities[:, p].tolist(), mz, float(rtmin[p]), float(rtmax[p]),
                                     initial_group, label))
     # to do: there are a case, when borders are empty
     # assert len(features) != 0
@@ -504,6 +635,51 @@ def calculate1dios(s1, s2):
     return res
 
 
+def basepeaks_correlation(peaks, max_elements=2 ** 22):
+    """
+    Calculate maximum cross-correlation (as in conv2correlation) for all pairs of peaks
+    :param peaks: a list of peaks (np.array)
+    :param max_elements: maximum size of intermediate arrays (to limit memory usage)
+    :return: (n_peaks x n_peaks) matrix, where element [i, j] is the maximum of
+        conv2correlation(peaks[i], peaks[j], np.convolve(peaks[i][::-1], peaks[j], mode='full'))
+    """
+    if not len(peaks):
+        return np.zeros((0, 0))
+    lengths = np.array([len(peak) for peak in peaks])
+    max_length = max(np.max(lengths), 1)
+    padded_peaks = np.zeros((len(peaks), max_length))
+    reflected_peaks = np.zeros((len(peaks), max_length))  # reflection is necessary
+    for k, peak in enumerate(peaks):
+        padded_peaks[k, :len(peak)] = peak
+        reflected_peaks[k, :len(peak)] = peak[::-1]
+    n_lags = 2 * max_length - 1
+    n_fft = next_fast_len(n_lags, real=True)
+    padded_fft = rfft(padded_peaks, n_fft, axis=1)
+    reflected_fft = rfft(reflected_peaks, n_fft, axis=1)
+    x = np.sum(padded_peaks, axis=1)
+    x_square = np.sum(padded_peaks ** 2, axis=1)
+
+    lags = np.arange(n_lags)
+    correlation = np.empty((len(peaks), len(peaks)))
+    step = max(max_elements // (len(peaks) * n_fft), 1)
+    for begin in range(0, len(peaks), step):
+        rows = slice(begin, begin + step)
+        conv = irfft(reflected_fft[rows, None, :] * padded_fft[None, :, :], n_fft, axis=2)[:, :, :n_lags]
+        # number of points in the union of shifted peaks for each lag
+        length_i = lengths[rows, None, None]
+        length_j = lengths[None, :, None]
+        intersection = np.minimum(np.minimum(lags + 1, length_i + length_j - 1 - lags),
+                                  np.minimum(length_i, length_j))
+        n = length_i + length_j - intersection
+        x_i, x_j = x[rows, None, None], x[None, :, None]
+        x_square_i, x_square_j = x_square[rows, None, None], x_square[None, :, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = (n * conv - x_i * x_j) / (np.sqrt(n * x_square_i - x_i ** 2) * np.sqrt(n * x_square_j - x_j ** 2))
+        corr[np.broadcast_to(lags >= length_i + length_j - 1, corr.shape)] = -np.inf
+        correlation[rows] = np.max(corr, axis=2)
+    return correlation
+
+
 def collapse_mzrtgroup(mzrtgroup, code):
     """
     Collapse features from the same component based on peaks similarities
@@ -516,43 +692,37 @@ def collapse_mzrtgroup(mzrtgroup, code):
         label2idx[feature.similarity_group].append(idx)
     unique_labels = list(set(label for label in label2idx))  # to do: not the best way :)
 
-    # find most intense peaks in each feature
-    idx2basepeak = dict()  # feature id in mzrtgroup to basepeak (np.array)
-    for idx, feature in enumerate(mzrtgroup):
-        n = 0
-        for k in range(1, len(feature)):
-            if feature.intensities[k] > feature.intensities[n]:
-                n = k
+    # find most intense peaks in each feature (feature id in mzrtgroup is an index in the lists)
+    basepeaks, basepeaks_rt = [], []
+    for feature in mzrtgroup:
+        n = int(np.argmax(feature.intensities))
         b, e = feature.borders[n]
-        basepeak = np.array(feature.rois[n].i[b:e])
-        idx2basepeak[idx] = {'peak': basepeak, 'rt': (feature.rtmin, feature.rtmax)}
-
+        basepeaks.append(np.asarray(feature.rois[n].i)[b:e])  # a view if intensities are np.array
+        basepeaks_rt.append((feature.rtmin, feature.rtmax))
+    # cross-correlation between all basepeaks at once
+    correlation = basepeaks_correlation(basepeaks)
 
     similarity_values = np.zeros((len(mzrtgroup), len(mzrtgroup), 2))
     feature_n = 0
     for i, label in enumerate(unique_labels):
         for idx in label2idx[label]:  # iter over features in one similarity group (from the same ROI)
-            base_peak = idx2basepeak[idx]['peak']
-            base_rt = idx2basepeak[idx]['rt']
+            base_rt = basepeaks_rt[idx]
             similarity_values[feature_n][idx] = (1, 1)
 
             for j, comp_label in enumerate(unique_labels[i + 1:]):
                 for jdx in label2idx[comp_label]:
-                    comp_peak = idx2basepeak[jdx]['peak']
-                    comp_rt = idx2basepeak[jdx]['rt']
+                    comp_rt = basepeaks_rt[jdx]
                     # calculate 'iou'
                     inter = calculate1dios(base_rt, comp_rt)
-                    # calculate cross-correlation
-                    conv_vector = np.convolve(base_peak[::-1], comp_peak, mode='full')
-                    corr_vector = conv2correlation(base_peak, comp_peak, conv_vector)
-                    corr = np.max(corr_vector)
+                    # cross-correlation
+                    corr = correlation[idx, jdx]
                     if inter > 0.8 or corr > 0.8:
                         similarity_values[feature_n][jdx] = [inter, corr]
             feature_n += 1
 
     # to do: completely rewrite it
     # from similarity_values construct mapping matrix
-    mapping_matrix = np.eye(len(mzrtgroup), dtype=np.int)
+    mapping_matrix = np.eye(len(mzrtgroup), dtype=np.int8)  # values are 0/1
     for i, label in enumerate(unique_labels):
         for j, comp_label in enumerate(unique_labels[i + 1:]):
             submatrix = similarity_values[label2idx[label]][:, label2idx[comp_label]]
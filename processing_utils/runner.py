@@ -1,14 +1,40 @@
 import os
-import numpy as np
+import torch
+from itertools import chain, islice
 try:
     from cython_utils.roi import get_ROIs
 except ImportError:
     from processing_utils.roi import get_ROIs
 from processing_utils.matching import construct_mzregions, rt_grouping, align_component
-from processing_utils.run_utils import preprocess, get_borders, Feature, \
+from processing_utils.run_utils import preprocess, preprocessed_batches, get_domain_borders, Feature, \
     border_correction, build_features, feature_collapsing
 
 
+def optimize_model(model, device):
+    """
+    Switch an ANN model to evaluation mode and compile it with TorchScript for inference on GPU
+
+    Parameters
+    ----------
+    model : nn.Module
+        an ANN model
+    device : torch.device
+        -
+    Returns
+    -------
+    model : nn.Module
+        compiled model (the same model on CPU or if it can't be compiled)
+    """
+    model = model.eval()  # once at load time, the runner never trains
+    if torch.device(device).type == 'cuda':
+        try:
+            # freezing folds parameters into the graph and enables kernel fusion (conv + batch norm, etc.)
+            model = torch.jit.optimize_for_inference(torch.jit.script(model))
+        except (RuntimeError, torch.jit.frontend.FrontendError):
+            pass  # eager mode
+    return model
+
+
 class BasicRunner:
     """
     A runner to process single roi
@@ -21,31 +47,36 @@ class BasicRunner:
         a list of models
     peak_minimum_points : int
         -
+    batch_size : int
+        -
 
     Attributes
     ----------
     mode : str
         A one of two 'all in one' of 'sequential'
     model : nn.Module
-        an ANN model if mode is 'all in one' (optional)
+        an ANN model if mode is 'all in one' (optional, compiled on GPU)
     classifier : nn.Module
-        an ANN model for classification (optional)
+        an ANN model for classification (optional, compiled on GPU)
     segmentator : nn.Module
-        an ANN model for segmentation (optional)
+        an ANN model for segmentation (optional, compiled on GPU)
     peak_minimum_points : int
         minimum peak length in points
+    batch_size : int
+        number of ROIs processed by ANN models at once
 
     """
-    def __init__(self, mode, models, peak_minimum_points, device):
+    def __init__(self, mode, models, peak_minimum_points, device, batch_size=64):
         self.mode = mode
         if self.mode == 'all in one':
-            self.model = models[0]
+            self.model = optimize_model(models[0], device)
         elif self.mode == 'sequential':
-            self.classifier, self.segmentator = models
+            self.classifier, self.segmentator = [optimize_model(model, device) for model in models]
         else:
             assert False, mode
         self.peak_minimum_points = peak_minimum_points
         self.device = device
+        self.batch_size = batch_size
 
     def __call__(self, roi, sample_name, progress_callback=None, operation_callback=None):
         """
@@ -62,33 +93,120 @@ class BasicRunner:
         feature : list
             a list of  'Feature' objects
         """
+        return self._roi2features(roi, self.predict([roi])[0], sample_name)
+
+    def predict(self, rois):
+        """
+        Classification and integration of ROIs
+
+        Parameters
+        ----------
+        rois : list
+            a list of ROI objects
+        Returns
+        -------
+        borders : list
+            borders (n_peaks x 2) for every roi or None if roi doesn't contain peaks
+        """
+        return [borders for batch_borders in self.predict_batches(rois) for borders in batch_borders]
+
+    @torch.inference_mode()
+    def predict_batches(self, rois):
+        """
+        Classification and integration of ROIs batch by batch. All ROIs go through the single
+        pipeline of preprocessing, so the next batch is prepared while the current one is processed
+
+        Parameters
+        ----------
+        rois : list
+            a list of ROI objects
+        Yields
+        -------
+        borders : list
+            borders (n_peaks x 2) for every roi in the next batch_size rois
+            or None if roi doesn't contain peaks
+        """
         if self.mode == 'all in one':
-            signal = preprocess(roi.i, self.device)
-            classifier_output, segmentator_output = self.model(signal)
+            # rois have different length, so they are processed one by one
+            for k in range(0, len(rois), self.batch_size):
+                batch_borders = []
+                for roi in rois[k:k + self.batch_size]:
+                    signal = preprocess(roi.i, self.device)
+                    classifier_output, segmentator_output = self.model(signal)
+                    label = int(classifier_output.argmax(1).item())
+                    if label == 1:
+                        domain = self._integration_domain(segmentator_output)
+                        batch_borders.append(get_domain_borders(domain[0],
+                                                                peak_minimum_points=self.peak_minimum_points))
+                    else:
+                        batch_borders.append(None)
+                yield batch_borders
         elif self.mode == 'sequential':
-            signal = preprocess(roi.i, self.device, interpolate=True, length=256)
-            classifier_output, _ = self.classifier(signal)
-            # to do: second step should be only for peaks
-            _, segmentator_output = self.segmentator(signal)
+            batches = preprocessed_batches([roi.i for roi in rois], self.device, 256, self.batch_size)
+            for k, signal in zip(range(0, len(rois), self.batch_size), batches):
+                batch = rois[k:k + self.batch_size]
+                classifier_output, _ = self.classifier(signal)
+                # peaks are selected on device: the signal stays there and feeds the segmentator directly
+                peaks = torch.nonzero(classifier_output.argmax(1) == 1).view(-1)
+                batch_borders = [None] * len(batch)
+                if len(peaks):  # second step only for peaks
+                    _, segmentator_output = self.segmentator(signal.index_select(0, peaks))
+                    domain = self._integration_domain(segmentator_output)
+                    for n, roi_n in enumerate(peaks.tolist()):
+                        roi = batch[roi_n]
+                        batch_borders[roi_n] = get_domain_borders(domain[n],
+                                                                  peak_minimum_points=self.peak_minimum_points,
+                                                                  interpolation_factor=signal.shape[-1] / len(roi.i))
+                yield batch_borders
         else:
             assert False, self.mode
-        classifier_output = classifier_output.data.cpu().numpy()
-        segmentator_output = segmentator_output.data.sigmoid().cpu().numpy()
 
-        # get label
-        label = np.argmax(classifier_output)
-        # get borders
+    @staticmethod
+    def _integration_domain(segmentator_output, threshold=0.5):
+        """
+        Threshold segmentator output on device, so only bool mask is transferred to host
+
+        Parameters
+        ----------
+        segmentator_output : torch.Tensor
+            logits of integration and intersection masks (n_rois x 2 x n_points)
+        threshold : float
+            threshold for probability of integration domain
+
+        Returns
+        -------
+        domain : np.ndarray
+            bool mask of integration domain (n_rois x n_points)
+        """
+        segmentator_output = segmentator_output.sigmoid()
+        domain = segmentator_output[:, 0, :] * (1 - segmentator_output[:, 1, :]) > threshold
+        return domain.cpu().numpy()
+
+    def _roi2features(self, roi, borders, sample_name):
+        """
+        Build features from the borders predicted for single roi
+
+        Parameters
+        ----------
+        roi : ROI
+            -
+        borders : list
+            a list of borders (n_peaks x 2) or None if roi doesn't contain peaks
+        sample_name : str
+            Arbitrary sample name
+        Returns
+        -------
+        feature : list
+            a list of  'Feature' objects
+        """
         features = []
-        if label == 1:
-            borders = get_borders(segmentator_output[0, 0, :], segmentator_output[0, 1, :],
-                                  peak_minimum_points=self.peak_minimum_points,
-                                  interpolation_factor=len(signal[0, 0]) / len(roi.i))
+        if borders is not None:
             for border in borders:
                 # to do: check correctness of rt calculations
                 scan_frequency = (roi.scan[1] - roi.scan[0]) / (roi.rt[1] - roi.rt[0])
                 rtmin = roi.rt[0] + border[0] / scan_frequency
                 rtmax = roi.rt[0] + border[1] / scan_frequency
-                feature = Feature([sample_name], [roi], [border], [0], [np.sum(roi.i[border[0]:border[1]])],
+                feature = Feature([sample_name], [roi], [border], [0], [roi.integrate(border[0], border[1])],
                                   roi.mzmean, rtmin, rtmax, 0, 0)
                 features.append(feature)
         return features
@@ -110,6 +228,8 @@ class FilesRunner(BasicRunner):
         -
     peak_minimum_points : int
         -
+    batch_size : int
+        -
 
     Attributes
     ----------
@@ -129,12 +249,14 @@ class FilesRunner(BasicRunner):
         maximal number of zero points in a row (for ROI detection)
     peak_minimum_points : int
         minimum peak length in points
+    batch_size : int
+        number of ROIs processed by ANN models at once
 
     """
     def __init__(self, mode, models, delta_mz,
                  required_points, dropped_points,
-                 peak_minimum_points, device):
-        super(FilesRunner, self).__init__(mode, models, peak_minimum_points, device)
+                 peak_minimum_points, device, batch_size=64):
+        super(FilesRunner, self).__init__(mode, models, peak_minimum_points, device, batch_size)
         self.delta_mz = delta_mz
         self.required_points = required_points
         self.dropped_points = dropped_points
@@ -171,9 +293,9 @@ class FilesRunner(BasicRunner):
         percentage = -1
         if operation_callback is not None:
             operation_callback.emit(f'Finding peaks in detected ROIs:')
-        for i, roi in enumerate(rois):
-            features_from_roi = super(FilesRunner, self).__call__(roi, file)
-            features.extend(features_from_roi)
+        for i, batch_borders in zip(range(0, len(rois), self.batch_size), self.predict_batches(rois)):
+            for roi, borders in zip(rois[i:i + self.batch_size], batch_borders):
+                features.extend(self._roi2features(roi, borders, file))
             new_percentage = int(i * 100 / len(rois))
             if progress_callback is not None and new_percentage > percentage:
                 percentage = new_percentage
@@ -222,39 +344,21 @@ class FilesRunner(BasicRunner):
         if operation_callback is not None:
             operation_callback.emit(f'Finding peaks in detected ROIs:')
         # Classification, integration and correction
+        # rois of all components are predicted in one pipeline (lazily, component by component)
+        predictions = chain.from_iterable(self.predict_batches([roi for component in aligned_components
+                                                                for roi in component.rois]))
         component_number = 0
         features = []
         percentage = -1
         for j, component in enumerate(aligned_components):  # run through components
             borders = {}  # borders for rois with peaks
             to_delete = []  # noisy rois in components
-            for i, (sample, roi) in enumerate(zip(component.samples, component.rois)):
-                if self.mode == 'all in one':
-                    signal = preprocess(roi.i, self.device)
-                    classifier_output, segmentator_output = self.model(signal)
-                    classifier_output = classifier_output.data.cpu().numpy()
-                    label = np.argmax(classifier_output)
-                    if label == 1:
-                        segmentator_output = segmentator_output.data.sigmoid().cpu().numpy()
-                        borders[sample] = get_borders(segmentator_output[0, 0, :], segmentator_output[0, 1, :],
-                                                      peak_minimum_points=self.peak_minimum_points)
-                    else:
-                        to_delete.append(i)
-                elif self.mode == 'sequential':
-                    signal = preprocess(roi.i, self.device, interpolate=True, length=256)
-                    classifier_output, _ = self.classifier(signal)
-                    classifier_output = classifier_output.data.cpu().numpy()
-                    label = np.argmax(classifier_output)
-                    if label == 1:
-                        _, segmentator_output = self.segmentator(signal)
-                        segmentator_output = segmentator_output.data.sigmoid().cpu().numpy()
-                        borders[sample] = get_borders(segmentator_output[0, 0, :], segmentator_output[0, 1, :],
-                                                      peak_minimum_points=self.peak_minimum_points,
-                                                      interpolation_factor=len(signal[0, 0]) / len(roi.i))
-                    else:
-                        to_delete.append(i)
+            component_borders = islice(predictions, len(component.rois))
+            for i, (sample, roi_borders) in enumerate(zip(component.samples, component_borders)):
+                if roi_borders is not None:
+                    borders[sample] = roi_borders
                 else:
-                    assert False, self.mode
+                    to_delete.append(i)
 
             if len(borders) > len(files) // 3:  # enough rois contain a peak
                 component.pop(to_delete)  # delete ROIs which don't contain peaks
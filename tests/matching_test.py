@@ -2,7 +2,7 @@ import unittest
 import numpy as np
 from collections import defaultdict
 
-from processing_utils.matching import stitch_component, align_component
+from processing_utils.matching import stitch_component, align_component, groupedROI
 from processing_utils.roi import ROI
 
 
@@ -101,6 +101,11 @@ class MyTestCase(unittest.TestCase):
             shifts[sample] = shift
         self.assertEqual([0, 0], group.shifts)
 
+    def test_group2idx(self):
+        group = groupedROI([None] * 5, [0] * 5, ['s1', 's2', 's3', 's4', 's5'], [1, 0, 1, 2, 0])
+        group2idx = {label: list(idx) for label, idx in group.group2idx().items()}
+        self.assertEqual({0: [1, 4], 1: [0, 2], 2: [3]}, group2idx)
+
 
 if __name__ == '__main__':
     unittest.main()
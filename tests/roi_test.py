@@ -0,0 +1,17 @@
+import unittest
+import numpy as np
+
+from processing_utils.roi import ROI
+
+
+class MyTestCase(unittest.TestCase):
+    def test_integrate(self):
+        i = np.array([0, 1, 2, 3, 4, 0], dtype=np.float32)
+        roi = ROI([0, 5], [0, 1], i, [100] * 6, 100)
+        for begin, end in [(0, 6), (1, 4), (2, 3), (3, 3), (4, 2), (3, 10)]:
+            self.assertAlmostEqual(np.sum(i[begin:end]), roi.integrate(begin, end))
+        self.assertEqual(7, len(roi.cumsum))
+
+
+if __name__ == '__main__':
+    unittest.main()
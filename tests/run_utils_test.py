@@ -0,0 +1,115 @@
+import os
+import unittest
+import tempfile
+import numpy as np
+from scipy.interpolate import interp1d
+
+from processing_utils.roi import ROI
+from processing_utils.matching import conv2correlation, groupedROI
+from processing_utils.run_utils import find_mzML, preprocess, preprocess_batch, domain2borders, \
+    get_borders,     border2average_correction, basepeaks_correlation, build_features, feature_collapsing
+
+
+class MyTestCase(unittest.TestCase):
+    def test_find_mzML(self):
+        with tempfile.TemporaryDirectory() as path:
+            os.makedirs(os.path.join(path, 'a', 'b'))
+            os.makedirs(os.path.join(path, 'c.mzML'))  # directory, not a file
+            expected = []
+            for name in [('1.mzML',), ('a', '2.mzML'), ('a', 'b', '3.mzML')]:
+                expected.append(os.path.join(path, *name))
+                open(expected[-1], 'w').close()
+            open(os.path.join(path, 'a', '4.txt'), 'w').close()
+            self.assertEqual(sorted(expected), sorted(find_mzML(path)))
+
+    def test_preprocess_batch(self):
+        length = 256
+        signals = [np.random.rand(n) for n in [2, 17, 256, 1000]]
+        batch = preprocess_batch(signals, 'cpu', length).numpy()
+        self.assertEqual((len(signals), 1, length), batch.shape)
+        for signal, preprocessed in zip(signals, batch):
+            interpolate = interp1d(np.arange(len(signal)), signal, kind='linear')
+            expected = interpolate(np.arange(length) / (length - 1) * (len(signal) - 1))
+            np.testing.assert_allclose(expected / np.max(expected), preprocessed[0], atol=1e-4)  # float32 positions
+            single = preprocess(signal, 'cpu', interpolate=True, length=length).numpy()
+            np.testing.assert_allclose(single[0, 0], preprocessed[0], atol=1e-5)
+
+    def test_domain2borders_without_splitter(self):
+        i = np.ones(256)
+        i[35:60] = 5
+        roi = ROI([0, 255], [0, 1], i, [100] * 256, 100)
+        domain = np.zeros(256, dtype=bool)
+        domain[10:30] = True
+        domain[35:60] = True
+        split = np.zeros(256, dtype=bool)
+        # the less intense peak is deleted
+        self.assertEqual([[35, 61]], domain2borders(roi, split, domain, peak_minimum_points=5))
+
+    def test_domain2borders_with_splitter(self):
+        roi = ROI([0, 255], [0, 1], np.ones(256), [100] * 256, 100)
+        domain = np.zeros(256, dtype=bool)
+        domain[10:30] = True
+        domain[35:60] = True
+        split = np.zeros(256, dtype=bool)
+        split[32] = True
+        self.assertEqual([[10, 31], [35, 61]], domain2borders(roi, split, domain, peak_minimum_points=5))
+
+    def test_get_borders(self):
+        integration_mask = np.array([0, 1, 1, 1, 0, 0, 1, 1, 0, 1, 1, 1, 1, 1, 1], dtype=float)
+        intersection_mask = np.zeros(len(integration_mask))
+        borders = get_borders(integration_mask, intersection_mask, peak_minimum_points=1)
+        self.assertEqual([[1, 5], [6, 9], [9, 15]], borders)
+
+    def test_get_borders_minimum_points(self):
+        integration_mask = np.array([0, 1, 1, 1, 0, 0, 1, 1, 0, 0], dtype=float)
+        intersection_mask = np.array([0, 0, 0, 0, 0, 0, 0, 1, 0, 0], dtype=float)
+        borders = get_borders(integration_mask, intersection_mask, peak_minimum_points=2)
+        self.assertEqual([[1, 5]], borders)
+
+    def test_border2average_correction_missed_peak(self):
+        borders = [[0, 10], [20, 30]]
+        averaged_borders = [[1, 11], [21, 29], [40, 50]]
+        corrected_borders = border2average_correction(borders, averaged_borders)
+        self.assertEqual([[0, 10], [20, 30], [40, 50]], corrected_borders)
+
+    def test_border2average_correction_redundant_separation(self):
+        borders = [[0, 10], [11, 20]]
+        averaged_borders = [[0, 20]]
+        corrected_borders = border2average_correction(borders, averaged_borders)
+        self.assertEqual([[0, 20]], corrected_borders)
+
+    def test_basepeaks_correlation(self):
+        peaks = [np.random.rand(n) for n in [5, 12, 7, 12, 3]]
+        correlation = basepeaks_correlation(peaks)
+        for i, base_peak in enumerate(peaks):
+            for j, comp_peak in enumerate(peaks):
+                conv_vector = np.convolve(base_peak[::-1], comp_peak, mode='full')
+                corr = np.max(conv2correlation(base_peak, comp_peak, conv_vector))
+                self.assertAlmostEqual(corr, correlation[i, j])
+        self.assertEqual((0, 0), basepeaks_correlation([]).shape)
+
+    def test_feature_collapsing_empty(self):
+        self.assertEqual([], feature_collapsing([]))
+
+    def test_build_features(self):
+        rois = [ROI([0, 4], [0., 2.], [1., 2., 3., 4., 5.], [100.] * 5, 100.),
+                ROI([0, 5], [1., 3.5], [1., 1., 1., 1., 1., 1.], [102.] * 6, 102.)]
+        component = groupedROI(rois, [0, 0], ['s1', 's2'], [0, 0])
+        borders = {'s1': [[0, 2], [2, 5]], 's2': [[1, 3], [4, 6]]}
+        features = build_features(component, borders, initial_group=7)
+        self.assertEqual(2, len(features))
+        first, second = features
+        self.assertEqual(['s1', 's2'], first.samples)
+        self.assertEqual([[0, 2], [1, 3]], first.borders)
+        np.testing.assert_allclose([3., 2.], first.intensities)
+        np.testing.assert_allclose([12., 2.], second.intensities)
+        self.assertAlmostEqual(101., first.mz)
+        self.assertAlmostEqual(0., first.rtmin)
+        self.assertAlmostEqual(2.5, first.rtmax)
+        self.assertAlmostEqual(1., second.rtmin)
+        self.assertAlmostEqual(4., second.rtmax)
+        self.assertEqual(7, second.mzrtgroup)
+
+
+if __name__ == '__main__':
+    unittest.main()
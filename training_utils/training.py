@@ -43,7 +43,7 @@ def iou(logits, y_true, smooth=1e-2):
 
     for i in range(channels):
         pred = logits[:, i, :] > 0.5
-        gt = y_true[:, i, :].astype(np.bool)
+        gt = y_true[:, i, :].astype(np.bool_)
         intersection = (pred & gt).sum(axis=1)
         union = (pred | gt).sum(axis=1)
         values[i] = np.mean((intersection + smooth) / (union + smooth))